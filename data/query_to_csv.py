@@ -1,193 +1,500 @@
 #!/usr/bin/env python3
 import os
 import csv
+import gzip
+import pyarrow.csv
+import pyarrow.parquet
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
+from google.cloud import storage
 from google.oauth2 import service_account
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
 import argparse
 import sys
+import queue
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from operator import itemgetter
+
+# Large output buffer so batches go to disk in few, big write calls
+OUTPUT_BUFFER_SIZE = 16 * 1024 * 1024
+
+# Record batches are encoded without a header, which is written once per
+# file. Arrow always quotes string values, unlike csv.writer, and has no
+# option for minimal quoting; d3.csv reads either form
+CSV_WRITE_OPTIONS = pyarrow.csv.WriteOptions(include_header=False, quoting_style='needed')
+
+# HTTP connections kept open for reuse, enough for every query's result
+# fetch and shard download to run concurrently
+HTTP_POOL_SIZE = 32
+
+# Shard downloads per exported file; with all eight files exporting at
+# once this stays within HTTP_POOL_SIZE connections
+DOWNLOAD_WORKERS = 4
+
+# Rows per tabledata.list request when paging results through the REST API
+ROW_PAGE_SIZE = 100000
+
+# Seconds the page prefetch thread waits on a full queue before checking
+# whether the writer has stopped
+PREFETCH_PUT_TIMEOUT = 1
+
+# Threads encoding record batches to CSV; Arrow's encoder releases the GIL
+ENCODE_WORKERS = os.cpu_count() or 1
+
+# Object prefix for files exported to Cloud Storage
+EXPORT_PREFIX = "gbif-visuals-summary"
+
+OCCURRENCES_TABLE = "bigquery-public-data.gbif.occurrences"
+
+# Taxonomic levels aggregated together with their parent level, as
+# (output file, level column, parent column)
+TAXONOMY_LEVELS = [
+    ("phyla.csv", "phylum", "kingdom"),
+    ("classes.csv", "class", "phylum"),
+    ("orders.csv", "`order`", "class"),
+    ("families.csv", "family", "`order`"),
+    ("genera.csv", "genus", "family"),
+]
+
+# User-owned table caching PRESENT_TAXA_QUERY, created in --project-id
+CACHE_DATASET = "gbif_cache"
+CACHE_TABLE = "present_taxa"
+
+# Presence records projected down to the columns the aggregates use
+PRESENT_TAXA_QUERY = f"""
+    SELECT
+      phylum,
+      kingdom,
+      class,
+      `order`,
+      family,
+      genus,
+      species,
+      countrycode,
+      year,
+      SAFE_CAST(individualcount AS INT64) as ic
+    FROM `{OCCURRENCES_TABLE}`
+    WHERE occurrencestatus = 'PRESENT'
+"""
 
 def setup_client(key_path, project_id):
-    """Setup BigQuery client with service account credentials"""
+    """Setup BigQuery, BigQuery Storage and Cloud Storage clients with service account credentials"""
     credentials = service_account.Credentials.from_service_account_file(
         key_path,
-        scopes=["https://www.googleapis.com/auth/bigquery"]
+        scopes=[
+            "https://www.googleapis.com/auth/bigquery",
+            "https://www.googleapis.com/auth/devstorage.read_write",
+        ]
+    )
+    # Share one authorized session with a larger connection pool, so
+    # concurrent requests reuse connections instead of new TLS handshakes
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    
+    client = bigquery.Client(credentials=credentials, project=project_id, _http=session)
+    # The Storage Read API streams results as Arrow record batches instead of
+    # paging JSON rows through tabledata.list
+    bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=credentials)
+    storage_client = storage.Client(credentials=credentials, project=project_id, _http=session)
+    return client, bqstorage_client, storage_client
+
+def get_job_config(year_from=None, batch=False):
+    """Return query job config binding the query parameters and priority"""
+    query_parameters = []
+    if year_from is not None:
+        query_parameters.append(bigquery.ScalarQueryParameter('year_from', 'INT64', year_from))
+    # Batch jobs wait for idle slots instead of counting against the
+    # interactive concurrency limit
+    priority = bigquery.QueryPriority.BATCH if batch else bigquery.QueryPriority.INTERACTIVE
+    return bigquery.QueryJobConfig(
+        query_parameters=query_parameters,
+        use_query_cache=True,
+        priority=priority,
     )
-    return bigquery.Client(credentials=credentials, project=project_id)
 
-def run_query(client, query):
-    """Execute query and return results"""
-    query_job = client.query(query)
-    return query_job.result()
+def run_query(client, query, job_config=None):
+    """Submit query and return the job without waiting for it to finish"""
+    return client.query(query, job_config=job_config)
+
+def open_output(output_path, text=False):
+    """Open output file for writing, gzip-compressed if the path ends in .gz"""
+    if output_path.endswith('.gz'):
+        # Level 1 is nearly free on the CPU and still roughly halves CSV size
+        if text:
+            return gzip.open(output_path, 'wt', newline='', compresslevel=1)
+        return gzip.open(output_path, 'wb', compresslevel=1)
+    if text:
+        return open(output_path, 'w', newline='', buffering=OUTPUT_BUFFER_SIZE)
+    return open(output_path, 'wb', buffering=OUTPUT_BUFFER_SIZE)
+
+def save_results(job, output_path, bqstorage_client, output_format='csv'):
+    """Wait for a query job and save its results to CSV or Parquet file"""
+    results = job.result()
+    
+    if output_format == 'parquet':
+        # Write the columnar result as-is, no text encoding needed. Without a
+        # Storage API client, stop to_arrow from creating one and page over
+        # REST instead
+        table = results.to_arrow(
+            bqstorage_client=bqstorage_client,
+            create_bqstorage_client=bqstorage_client is not None,
+        )
+        pyarrow.parquet.write_table(table, output_path, compression='zstd', compression_level=3)
+        return
+    
+    # Stream Arrow record batches from the Storage API, encode them to CSV in
+    # parallel and write the encoded batches in their original order
+    with open_output(output_path) as f, \
+            ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as executor:
+        # Quote the header like the string values Arrow writes below
+        f.write((','.join(f'"{field.name}"' for field in results.schema) + '\n').encode())
+        
+        pending = deque()
+        for batch in results.to_arrow_iterable(bqstorage_client=bqstorage_client):
+            pending.append(executor.submit(_encode_batch, batch))
+            # Bound the number of encoded batches held in memory
+            if len(pending) > 2 * ENCODE_WORKERS:
+                f.write(pending.popleft().result())
+        while pending:
+            f.write(pending.popleft().result())
+
+def _encode_batch(batch):
+    """Encode an Arrow record batch as CSV rows without a header"""
+    sink = pyarrow.BufferOutputStream()
+    pyarrow.csv.write_csv(batch, sink, write_options=CSV_WRITE_OPTIONS)
+    return sink.getvalue()
 
-def save_to_csv(results, output_path):
-    """Save query results to CSV file"""
-    # Ensure output directory exists
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+def save_rows_to_csv(job, output_path):
+    """Wait for a query job and save its results to CSV file row by row"""
+    # Request large pages so fewer round trips are needed
+    results = job.result(page_size=ROW_PAGE_SIZE)
     
     # Get the schema field names
     field_names = [field.name for field in results.schema]
     
-    with open(output_path, 'w', newline='') as f:
+    with open_output(output_path, text=True) as f:
         writer = csv.writer(f)
         # Write header
         writer.writerow(field_names)
-        # Write data
-        for row in results:
-            writer.writerow([row[field] for field in field_names])
-
-def get_queries():
-    """Return dictionary of all queries to run"""
-    return {
-        "phyla.csv": """
+        # Write data page by page while the next page is fetched in the
+        # background, so network and CSV encoding overlap
+        pages = queue.Queue(maxsize=2)
+        stop = threading.Event()
+        getter = _get_row_getter(len(field_names))
+        threading.Thread(
+            target=_prefetch_pages, args=(results, pages, getter, stop), daemon=True
+        ).start()
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                writer.writerows(page)
+        finally:
+            # Let the prefetch thread exit if writing stopped early
+            stop.set()
+
+def _get_row_getter(field_count):
+    """Return a function giving a row's values as a tuple, by position"""
+    # Positional itemgetter avoids a lookup by field name for every cell
+    getter = itemgetter(*range(field_count))
+    if field_count == 1:
+        # itemgetter with a single index returns the bare value
+        return lambda row: (getter(row),)
+    return getter
+
+def _prefetch_pages(results, pages, getter, stop):
+    """Put result pages on a queue as lists of row tuples, then None"""
+    try:
+        for page in results.pages:
+            if not _put_page(pages, [getter(row) for row in page], stop):
+                return
+        _put_page(pages, None, stop)
+    except Exception as e:
+        # Hand the error to the writing thread
+        _put_page(pages, e, stop)
+
+def _put_page(pages, item, stop):
+    """Put item on the queue, giving up once stop is set; return whether it was put"""
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=PREFETCH_PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def get_export_prefix(filename, run_id):
+    """Return the Cloud Storage object prefix holding an exported file's shards"""
+    # Each run exports under its own prefix, so shards left by an earlier run
+    # can never be joined into this run's file
+    return f"{EXPORT_PREFIX}/{run_id}/{os.path.splitext(filename)[0]}/"
+
+def get_export_query(query, bucket_name, filename, run_id):
+    """Wrap query in EXPORT DATA so BigQuery writes the CSV to Cloud Storage"""
+    uri = f"gs://{bucket_name}/{get_export_prefix(filename, run_id)}part-*.csv"
+    return f"""
+        EXPORT DATA OPTIONS(
+          uri='{uri}',
+          format='CSV',
+          header=true,
+          overwrite=true
+        ) AS {query.strip().rstrip(';')};
+    """
+
+def download_export(job, output_path, storage_client, bucket_name, run_id):
+    """Wait for an EXPORT DATA job, join its shards into one CSV file and delete them"""
+    job.result()
+    
+    prefix = get_export_prefix(os.path.basename(output_path).removesuffix('.gz'), run_id)
+    blobs = sorted(storage_client.list_blobs(bucket_name, prefix=prefix), key=lambda blob: blob.name)
+    
+    # Download shards in parallel and write each one as soon as it and the
+    # shards before it are done, so only a few are held in memory
+    with open_output(output_path) as f, \
+            ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        pending = deque()
+        written = 0
+        for blob in blobs:
+            pending.append(executor.submit(blob.download_as_bytes))
+            if len(pending) > 2 * DOWNLOAD_WORKERS:
+                _write_shard(f, pending.popleft().result(), written)
+                written += 1
+        while pending:
+            _write_shard(f, pending.popleft().result(), written)
+            written += 1
+    
+    # The shards are only needed to build the local file
+    for blob in blobs:
+        blob.delete()
+
+def _write_shard(f, shard, index):
+    """Write an exported CSV shard, dropping the header repeated after the first"""
+    if index > 0:
+        shard = shard.partition(b'\n')[2]
+    f.write(shard)
+
+def get_level_query(source, level, parent):
+    """Return query counting occurrences of each taxon at level, with its parent"""
+    return f"""
             SELECT 
-              phylum,
-              kingdom,
+              {level},
+              {parent},
               COUNT(*) as occurrence_count,
-              SUM(CAST(individualcount AS INT64)) as individual_count
-            FROM `bigquery-public-data.gbif.occurrences`
-            WHERE phylum IS NOT NULL 
-              AND occurrencestatus = 'PRESENT'
-            GROUP BY phylum, kingdom
-            ORDER BY phylum;
-        """,
-        
-        "classes.csv": """
+              SUM(ic) as individual_count
+            FROM {source}
+            WHERE {level} IS NOT NULL 
+              AND {parent} IS NOT NULL
+            GROUP BY {level}, {parent}
+            ORDER BY {level};
+        """
+
+def get_queries(source=f"({PRESENT_TAXA_QUERY})", year_from=None):
+    """Return dictionary of all queries to run against the given source table"""
+    if year_from is not None:
+        # Only read records from @year_from onwards, so blocks holding older
+        # records can be pruned
+        source = f"(SELECT * FROM {source} WHERE year >= @year_from)"
+    
+    queries = {
+        filename: get_level_query(source, level, parent)
+        for filename, level, parent in TAXONOMY_LEVELS
+    }
+    queries.update({
+        "phyla-country.csv": f"""
             SELECT 
-              class,
               phylum,
+              countrycode as country,
               COUNT(*) as occurrence_count,
-              SUM(CAST(individualcount AS INT64)) as individual_count
-            FROM `bigquery-public-data.gbif.occurrences`
-            WHERE class IS NOT NULL 
-              AND phylum IS NOT NULL
-              AND occurrencestatus = 'PRESENT'
-            GROUP BY class, phylum
-            ORDER BY class;
-        """,
-        
-        "orders.csv": """
-            SELECT 
-              `order`,
-              class,
-              COUNT(*) as occurrence_count,
-              SUM(CAST(individualcount AS INT64)) as individual_count
-            FROM `bigquery-public-data.gbif.occurrences`
-            WHERE `order` IS NOT NULL 
-              AND class IS NOT NULL
-              AND occurrencestatus = 'PRESENT'
-            GROUP BY `order`, class
-            ORDER BY `order`;
-        """,
-        
-        "families.csv": """
-            SELECT 
-              family,
-              `order`,
-              COUNT(*) as occurrence_count,
-              SUM(CAST(individualcount AS INT64)) as individual_count
-            FROM `bigquery-public-data.gbif.occurrences`
-            WHERE family IS NOT NULL 
-              AND `order` IS NOT NULL
-              AND occurrencestatus = 'PRESENT'
-            GROUP BY family, `order`
-            ORDER BY family;
-        """,
-        
-        "genera.csv": """
-            SELECT 
-              genus,
-              family,
-              COUNT(*) as occurrence_count,
-              SUM(CAST(individualcount AS INT64)) as individual_count
-            FROM `bigquery-public-data.gbif.occurrences`
-            WHERE genus IS NOT NULL 
-              AND family IS NOT NULL
-              AND occurrencestatus = 'PRESENT'
-            GROUP BY genus, family
-            ORDER BY genus;
-        """,
-        
-        "phyla-country.csv": """
-            WITH RankedPhylaByCountry AS (
-              SELECT 
-                phylum,
-                countrycode as country,
-                COUNT(*) as occurrence_count,
-                ROW_NUMBER() OVER (PARTITION BY phylum ORDER BY COUNT(*) DESC) as rank
-              FROM `bigquery-public-data.gbif.occurrences`
-              WHERE phylum IS NOT NULL 
-                AND countrycode IS NOT NULL
-                AND occurrencestatus = 'PRESENT'
-              GROUP BY phylum, countrycode
-            )
-            SELECT 
-              phylum,
-              country,
-              occurrence_count,
-              rank
-            FROM RankedPhylaByCountry
-            WHERE rank <= 3
+              ROW_NUMBER() OVER (PARTITION BY phylum ORDER BY COUNT(*) DESC) as rank
+            FROM {source}
+            WHERE phylum IS NOT NULL 
+              AND countrycode IS NOT NULL
+            GROUP BY phylum, countrycode
+            QUALIFY rank <= 3
             ORDER BY phylum, rank;
         """,
         
-        "species.csv": """
-            WITH SpeciesRanks AS (
-              SELECT 
-                species,
-                genus,
-                COUNT(*) as occurrence_count,
-                SUM(CAST(individualcount AS INT64)) as individual_count,
-                ROW_NUMBER() OVER (PARTITION BY genus ORDER BY COUNT(*) DESC) as rank
-              FROM `bigquery-public-data.gbif.occurrences`
-              WHERE species IS NOT NULL 
-                AND genus IS NOT NULL
-                AND occurrencestatus = 'PRESENT'
-              GROUP BY species, genus
-            )
+        "species.csv": f"""
             SELECT 
               species,
               genus,
-              occurrence_count,
-              individual_count
-            FROM SpeciesRanks
-            WHERE rank <= 5
-            ORDER BY genus, rank;
+              COUNT(*) as occurrence_count,
+              SUM(ic) as individual_count
+            FROM {source}
+            WHERE species IS NOT NULL 
+              AND genus IS NOT NULL
+            GROUP BY species, genus
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY genus ORDER BY COUNT(*) DESC) <= 5
+            ORDER BY genus, occurrence_count DESC;
         """,
         
-        "kingdom.csv": """
+        "kingdom.csv": f"""
             SELECT 
               COALESCE(kingdom, 'incertae sedis') as kingdom,
               COUNT(*) as occurrence_count,
-              SUM(CAST(individualcount AS INT64)) as individual_count
-            FROM `bigquery-public-data.gbif.occurrences`
-            WHERE occurrencestatus = 'PRESENT'
+              SUM(ic) as individual_count
+            FROM {source}
             GROUP BY kingdom
             ORDER BY kingdom;
         """
-    }
+    })
+    return queries
+
+def get_cache_table(project_id):
+    """Return the fully qualified name of the cached presence projection"""
+    return f"{project_id}.{CACHE_DATASET}.{CACHE_TABLE}"
+
+def refresh_cache(client, project_id, job_config=None):
+    """Rebuild the cached presence projection, clustered by taxonomy"""
+    # Keep the cache in the same location as the public GBIF dataset
+    query = f"""
+        CREATE SCHEMA IF NOT EXISTS `{project_id}.{CACHE_DATASET}`
+        OPTIONS(location='US');
+        
+        CREATE OR REPLACE TABLE `{get_cache_table(project_id)}`
+        CLUSTER BY phylum, class, `order`, family
+        AS {PRESENT_TAXA_QUERY};
+    """
+    client.query(query, job_config=job_config).result()
+
+def get_script(queries, year_from=None):
+    """Combine queries into one script that scans the occurrences table once"""
+    base_query = PRESENT_TAXA_QUERY
+    if year_from is not None:
+        # Only copy records from @year_from onwards into the temp table
+        base_query = f"SELECT * FROM ({PRESENT_TAXA_QUERY}) WHERE year >= @year_from"
+    statements = [f"CREATE TEMP TABLE base AS {base_query};"]
+    statements.extend(queries.values())
+    return "\n".join(statements)
+
+def run_script(client, queries, job_config=None, year_from=None):
+    """Run queries as a single script and return a job per output file"""
+    script_job = client.query(get_script(queries, year_from), job_config=job_config)
+    script_job.result()
+    
+    # Each statement in the script runs as a child job; skip the one
+    # creating the temp table and match the rest to queries in order
+    child_jobs = sorted(client.list_jobs(parent_job=script_job), key=lambda job: job.created)
+    if len(child_jobs) != len(queries) + 1:
+        raise RuntimeError(
+            f"Expected {len(queries) + 1} child jobs from script {script_job.job_id}, "
+            f"got {len(child_jobs)}"
+        )
+    return dict(zip(queries, child_jobs[1:]))
 
 def main():
-    parser = argparse.ArgumentParser(description='Generate GBIF statistics CSV files')
+    parser = argparse.ArgumentParser(description='Generate GBIF statistics CSV or Parquet files')
     parser.add_argument('--key-file', required=True, help='Path to service account key file')
     parser.add_argument('--project-id', required=True, help='Google Cloud project ID')
+    source_group = parser.add_mutually_exclusive_group()
+    source_group.add_argument('--single-scan', action='store_true',
+                              help='Run all queries as one script that scans the occurrences table once')
+    source_group.add_argument('--use-cache', action='store_true',
+                              help='Read from the cached presence table in --project-id')
+    source_group.add_argument('--refresh-cache', action='store_true',
+                              help='Rebuild the cached presence table in --project-id and read from it')
+    parser.add_argument('--year-from', type=int,
+                        help='Only include occurrences recorded in or after this year')
+    parser.add_argument('--batch', action='store_true',
+                        help='Run queries at batch priority instead of interactive')
+    parser.add_argument('--export-bucket',
+                        help='Export results to this Cloud Storage bucket and download them from there')
+    parser.add_argument('--no-storage-api', action='store_true',
+                        help='Fetch results through the REST API instead of the BigQuery Storage API')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Write gzip-compressed .csv.gz files')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help='Output file format (default: csv)')
+    parser.add_argument('--outputs', nargs='+', choices=list(get_queries()), metavar='FILE',
+                        help='Only generate these files, named by their .csv name even with '
+                             '--format parquet, e.g. kingdom.csv (default: all)')
     args = parser.parse_args()
+    if args.format == 'parquet' and (args.gzip or args.export_bucket):
+        parser.error('--format parquet cannot be combined with --gzip or --export-bucket')
 
     try:
+        # Ensure output directory exists
+        os.makedirs('data', exist_ok=True)
+        
         # Setup BigQuery client
-        client = setup_client(args.key_file, args.project_id)
+        client, bqstorage_client, storage_client = setup_client(args.key_file, args.project_id)
+        job_config = get_job_config(args.year_from, args.batch)
         
-        # Get all queries
-        queries = get_queries()
+        if args.refresh_cache:
+            print(f"Refreshing cache table {get_cache_table(args.project_id)}...")
+            # The cache keeps every year, so only the priority applies here
+            refresh_cache(client, args.project_id, get_job_config(batch=args.batch))
         
-        # Run each query and save results
-        for filename, query in queries.items():
-            print(f"Executing query for {filename}...")
-            results = run_query(client, query)
-            
-            output_path = os.path.join('data', filename)
-            print(f"Saving results to {output_path}...")
-            save_to_csv(results, output_path)
-            print(f"Successfully generated {filename}")
+        if args.single_scan:
+            # The year filter is applied once, when the temp table is built
+            queries = get_queries(source='base')
+        elif args.use_cache or args.refresh_cache:
+            source = f"`{get_cache_table(args.project_id)}`"
+            queries = get_queries(source=source, year_from=args.year_from)
+        else:
+            queries = get_queries(year_from=args.year_from)
+        
+        if args.outputs:
+            # Skip the queries, and table scans, for files that weren't asked for
+            queries = {filename: queries[filename] for filename in args.outputs}
+        
+        if args.export_bucket:
+            # Have BigQuery write the CSV shards to Cloud Storage in parallel
+            run_id = uuid.uuid4().hex
+            queries = {
+                filename: get_export_query(query, args.export_bucket, filename, run_id)
+                for filename, query in queries.items()
+            }
+            save = partial(
+                download_export,
+                storage_client=storage_client,
+                bucket_name=args.export_bucket,
+                run_id=run_id,
+            )
+        elif args.no_storage_api and args.format == 'csv':
+            save = save_rows_to_csv
+        else:
+            save = partial(
+                save_results,
+                bqstorage_client=None if args.no_storage_api else bqstorage_client,
+                output_format=args.format,
+            )
+        
+        if args.single_scan:
+            # Materialize the presence projection once and aggregate over it
+            print("Running all queries as a single script...")
+            jobs = run_script(client, queries, job_config, args.year_from)
+        else:
+            # Submit every query up front so BigQuery runs them in parallel
+            jobs = {}
+            for filename, query in queries.items():
+                print(f"Submitting query for {filename}...")
+                jobs[filename] = run_query(client, query, job_config)
+        
+        if args.format == 'parquet':
+            jobs = {os.path.splitext(filename)[0] + '.parquet': job for filename, job in jobs.items()}
+        
+        if args.gzip:
+            jobs = {filename + '.gz': job for filename, job in jobs.items()}
+        
+        # Fetch results and write output files as each job completes
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = {
+                executor.submit(save, job, os.path.join('data', filename)): filename
+                for filename, job in jobs.items()
+            }
+            for future in as_completed(futures):
+                future.result()
+                print(f"Successfully generated {futures[future]}")
             
         print("All files generated successfully!")
         
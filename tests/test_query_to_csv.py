@@ -0,0 +1,68 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("pyarrow")
+pytest.importorskip("google.cloud.bigquery")
+pytest.importorskip("google.cloud.bigquery_storage")
+pytest.importorskip("google.cloud.storage")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'data'))
+
+import query_to_csv
+
+
+class FakeJob:
+    def result(self):
+        return None
+
+
+class FakeBlob:
+    def __init__(self, storage_client, name, data):
+        self.storage_client = storage_client
+        self.name = name
+        self.data = data
+
+    def download_as_bytes(self):
+        return self.data
+
+    def delete(self):
+        self.storage_client.blobs.remove(self)
+
+
+class FakeStorageClient:
+    def __init__(self):
+        self.blobs = []
+
+    def add_blob(self, name, data):
+        self.blobs.append(FakeBlob(self, name, data))
+
+    def list_blobs(self, bucket_name, prefix):
+        return [blob for blob in self.blobs if blob.name.startswith(prefix)]
+
+
+def test_export_query_writes_under_run_prefix():
+    query = query_to_csv.get_export_query("SELECT 1;", "bucket", "kingdom.csv", "run1")
+    assert "uri='gs://bucket/gbif-visuals-summary/run1/kingdom/part-*.csv'" in query
+
+
+def test_download_export_ignores_and_keeps_leftover_shards(tmp_path):
+    storage_client = FakeStorageClient()
+    # Shards left behind by earlier runs, including one with more shards
+    storage_client.add_blob("gbif-visuals-summary/kingdom/part-000000000002.csv", b"kingdom\nStale\n")
+    storage_client.add_blob("gbif-visuals-summary/run0/kingdom/part-000000000000.csv", b"kingdom\nOld\n")
+    storage_client.add_blob("gbif-visuals-summary/run0/kingdom/part-000000000001.csv", b"kingdom\nOlder\n")
+    storage_client.add_blob("gbif-visuals-summary/run0/kingdom/part-000000000002.csv", b"kingdom\nOldest\n")
+    # Shards written by this run
+    storage_client.add_blob("gbif-visuals-summary/run1/kingdom/part-000000000001.csv", b"kingdom\nPlantae\n")
+    storage_client.add_blob("gbif-visuals-summary/run1/kingdom/part-000000000000.csv", b"kingdom\nAnimalia\n")
+    leftover_names = [blob.name for blob in storage_client.blobs[:4]]
+
+    output_path = str(tmp_path / "kingdom.csv")
+    query_to_csv.download_export(FakeJob(), output_path, storage_client, "bucket", "run1")
+
+    with open(output_path, 'rb') as f:
+        assert f.read() == b"kingdom\nAnimalia\nPlantae\n"
+    # This run's shards are deleted once joined, earlier ones are untouched
+    assert [blob.name for blob in storage_client.blobs] == leftover_names